@@ -0,0 +1,43 @@
+"""County geometry I/O shared by streamlit_app.py and scripts/convert_geojson.py.
+
+maakonnad.geojson is the source of truth. A GeoParquet copy, already
+projected to DISPLAY_CRS, is preferred while it is at least as new.
+"""
+import os
+
+import geopandas as gpd
+import pyogrio
+
+GEOJSON_FILE = "maakonnad.geojson"
+PARQUET_FILE = "maakonnad.parquet"
+DISPLAY_CRS = 3301  # L-EST97, metres
+
+def parquet_is_current():
+    if not os.path.exists(PARQUET_FILE):
+        return False
+    # A deployment may ship the parquet alone.
+    return (not os.path.exists(GEOJSON_FILE)
+            or os.path.getmtime(PARQUET_FILE) >= os.path.getmtime(GEOJSON_FILE))
+
+def project(gdf):
+    if gdf.crs is not None and gdf.crs.to_epsg() != DISPLAY_CRS:
+        gdf = gdf.to_crs(DISPLAY_CRS)
+    return gdf
+
+def read_geojson():
+    return project(pyogrio.read_dataframe(GEOJSON_FILE, columns=['MNIMI'], use_arrow=True))
+
+def write_parquet(gdf):
+    # Write then rename, so a reader never sees a half-written copy.
+    gdf.to_parquet(PARQUET_FILE + '.tmp')
+    os.replace(PARQUET_FILE + '.tmp', PARQUET_FILE)
+
+def load_counties():
+    if parquet_is_current():
+        return project(gpd.read_parquet(PARQUET_FILE, columns=['MNIMI', 'geometry']))
+    gdf = read_geojson()
+    try:
+        write_parquet(gdf)
+    except OSError:
+        pass  # read-only filesystem; the copy is only an optimisation
+    return gdf
@@ -0,0 +1,17 @@
+"""Build the projected GeoParquet copy of maakonnad.geojson.
+
+Run at build time so fresh containers skip parsing the GeoJSON on their
+first load. Run from the repository root:
+
+    python scripts/convert_geojson.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import counties  # noqa: E402
+
+gdf = counties.read_geojson()
+counties.write_parquet(gdf)
+print(f"Wrote {len(gdf)} counties to {counties.PARQUET_FILE}")
@@ -1,15 +1,40 @@
 import streamlit as st
 import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
-from io import StringIO
+from io import BytesIO
+import functools
 import json
-import geopandas as gpd
-import matplotlib.pyplot as plt
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from matplotlib.collections import PolyCollection
+from matplotlib.figure import Figure
+
+import counties
 
 st.title("Estonian Population Natural Growth by County")
 
 STATISTIKAAMETI_API_URL = "https://andmed.stat.ee/api/v1/et/stat/RV032"
-GEOJSON_FILE = "maakonnad.geojson"
+API_CACHE_NAME = "stat_cache"  # stat_cache.sqlite
+API_CACHE_SECONDS = 86400
+API_TIMEOUT = (3, 15)  # connect, read (seconds)
+# Debug output (and the sidebar toggle for it) only exists with APP_DEBUG=1.
+DEBUG = os.getenv('APP_DEBUG') == '1'
+# Metres; the 12x8in map saved at 200 dpi is roughly 200 m per pixel, so this
+# stays under 2px.
+SIMPLIFY_TOLERANCE = 300
+
+CSV_DTYPES = {
+    'Aasta': 'int16',
+    'Maakond': 'category',
+    'Mehed Loomulik iive': 'int32',
+    'Naised Loomulik iive': 'int32',
+}
 
 JSON_PAYLOAD_STR = """ {
   "query": [
@@ -44,77 +69,237 @@ JSON_PAYLOAD_STR = """ {
   "response": { "format": "csv" }
 }
 """
+JSON_PAYLOAD = json.loads(JSON_PAYLOAD_STR)
+# Serialised once; posted as-is with an explicit JSON content type.
+JSON_PAYLOAD_BYTES = json.dumps(JSON_PAYLOAD, separators=(',', ':')).encode('utf-8')
+
+@st.cache_resource
+def cache_stats():
+    # Updated from concurrent sessions and the geometry worker thread, so every
+    # access goes through the lock.
+    return threading.Lock(), {}
+
+def tracked(cache):
+    # Wrap a loader in `cache` and record calls, actual (uncached) runs and the
+    # size of the last result.
+    def decorate(fn):
+        def record(calls=0, misses=0, seconds=0.0, **latest):
+            lock, stats = cache_stats()
+            with lock:
+                s = stats.setdefault(fn.__name__, {
+                    'calls': 0, 'misses': 0, 'seconds': 0.0, 'rows': None, 'last_refresh': None,
+                })
+                s['calls'] += calls
+                s['misses'] += misses
+                s['seconds'] += seconds
+                s.update(latest)
+
+        @functools.wraps(fn)
+        def load(*args, **kwargs):
+            # Count failed runs as misses too: exceptions aren't cached, so a
+            # failing loader runs again on every call.
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            finally:
+                record(misses=1, seconds=time.perf_counter() - start)
+            record(rows=len(result), last_refresh=time.strftime('%Y-%m-%d %H:%M:%S'))
+            return result
+
+        cached = cache(load)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            record(calls=1)
+            return cached(*args, **kwargs)
+        wrapper.clear = cached.clear
+        return wrapper
+    return decorate
 
-@st.cache_data
+@st.cache_resource
+def get_session():
+    # Responses persist on disk, so a restarted app doesn't go back to the API.
+    session = requests_cache.CachedSession(
+        API_CACHE_NAME,
+        expire_after=API_CACHE_SECONDS,
+        allowable_methods=('GET', 'HEAD', 'POST'),
+    )
+    # The query is read-only, so retrying the POST on a gateway error is safe.
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504],
+                  allowed_methods=['GET', 'HEAD', 'POST'])
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry))
+    return session
+
+# Expires with the on-disk response cache, so a long-running process picks up
+# new figures; the per-year caches below are keyed on the values for that.
+@tracked(st.cache_data(ttl=API_CACHE_SECONDS))
 def import_data():
     headers = {'Content-Type': 'application/json'}
-    payload = json.loads(JSON_PAYLOAD_STR)
     with st.spinner('Fetching data from Statistics Estonia...'):
-        r = requests.post(STATISTIKAAMETI_API_URL, json=payload, headers=headers)
-    if r.status_code == 200:
-        text = r.content.decode('utf-8-sig')
-        df = pd.read_csv(StringIO(text))
-        return df
-    else:
-        st.error(f"Failed to retrieve data: {r.status_code}")
-        st.write(r.text)
+        r = get_session().post(
+            STATISTIKAAMETI_API_URL, data=JSON_PAYLOAD_BYTES, headers=headers, timeout=API_TIMEOUT
+        )
+    # Raising keeps failures out of the cache; the caller reports them.
+    r.raise_for_status()
+    first_line = r.content.split(b'\n', 1)[0]
+    sep = ';' if first_line.count(b';') > first_line.count(b',') else ','
+    # Hand the raw bytes to the C parser; it strips the BOM itself.
+    return pd.read_csv(BytesIO(r.content), sep=sep, encoding='utf-8-sig', engine='c',
+                       usecols=list(CSV_DTYPES), dtype=CSV_DTYPES)
+
+def load_data():
+    try:
+        df = import_data()
+    except requests.HTTPError as e:
+        st.error(f"Failed to retrieve data: {e.response.status_code}")
+        if st.session_state.get('debug'):
+            st.text(e.response.text[:1000])
+        return None
+    except requests.RequestException as e:
+        st.error(f"Failed to retrieve data: {e}")
         return None
+    return df
 
-@st.cache_data
+# Geometry-bearing frames are cached as shared resources rather than pickled
+# on every hit; callers must treat them as read-only.
+@tracked(st.cache_resource(show_spinner=False))
 def import_geojson():
+    # Runs on a worker thread (see load_geojson), so no st.* calls in here.
+    # Projected geometry, from the GeoParquet copy when it is current.
+    gdf = counties.load_counties()
+    # Simplify the counties as one coverage so shared borders stay aligned.
+    gdf['geometry'] = gdf.geometry.simplify_coverage(tolerance=SIMPLIFY_TOLERANCE)
+    return gdf[['MNIMI', 'geometry']]
+
+def load_geojson(future):
     try:
         with st.spinner('Loading geographic data...'):
-            return gpd.read_file(GEOJSON_FILE)
+            return future.result()
     except Exception as e:
         st.error(f"Error loading GeoJSON file: {e}")
         return None
 
-def get_data_for_year(df, year):
-    return df[df.Aasta == year] if df is not None else None
+def county_key(names):
+    return names.str.removesuffix(' maakond').str.casefold()
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def prepare_map_data(df, _gdf):
+    # Join on a normalised name so "Harju maakond" and "harju" line up.
+    left = _gdf.assign(key=county_key(_gdf['MNIMI']))
+    right = df.assign(key=county_key(df['Maakond']))
+    merged = left.merge(right, on='key').drop(columns='key')
+    merged['Loomulik iive'] = merged['Mehed Loomulik iive'] + merged['Naised Loomulik iive']
+    # Split by year once so a selection is a dict lookup; keys are sorted.
+    return {int(year): group.reset_index(drop=True) for year, group in merged.groupby('Aasta', sort=True)}
+
+def get_data_for_year(year_groups, year):
+    return year_groups.get(year) if year_groups is not None else None
+
+# Keyed on the year's values like render_year, so the three per-year caches
+# are invalidated together when import_data refreshes.
+@st.cache_resource(max_entries=32, show_spinner=False)
+def year_table(year, values, _year_groups):
+    df = get_data_for_year(_year_groups, year)
+    table = df[['Maakond', 'Mehed Loomulik iive', 'Naised Loomulik iive', 'Loomulik iive']]
+    table = table.sort_values('Loomulik iive', ascending=False, ignore_index=True)
+    return table.rename(columns={'Loomulik iive': 'Kokku'})
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def year_csv_bytes(year, values, _year_groups):
+    # Geometry stays out of the export; WKT polygons would dwarf the figures.
+    df = get_data_for_year(_year_groups, year).drop(columns='geometry')
+    return df.to_csv(index=False).encode('utf-8')
 
 def create_plot(df, year):
     if df is None or df.empty:
         return None
-    fig, ax = plt.subplots(1, 1, figsize=(12, 8))
-    df.plot(
-        column='Loomulik iive',
-        ax=ax,
-        legend=True,
-        cmap='viridis',
-        legend_kwds={'label': "Loomulik iive"}
-    )
+    # One PolyCollection for all counties instead of an artist per polygon;
+    # multipolygon parts repeat their county's value.
+    verts, values = [], []
+    for geom, value in zip(df.geometry, df['Loomulik iive']):
+        parts = geom.geoms if geom.geom_type == 'MultiPolygon' else [geom]
+        for part in parts:
+            verts.append(np.asarray(part.exterior.coords))
+            values.append(value)
+    # A bare Figure (not pyplot) so years can be rendered from worker threads.
+    fig = Figure(figsize=(12, 8))
+    ax = fig.subplots(1, 1)
+    pc = PolyCollection(verts, array=np.asarray(values), cmap='viridis', edgecolor='black', linewidth=0.5)
+    ax.add_collection(pc)
+    ax.autoscale_view()
+    ax.set_aspect('equal')
+    fig.colorbar(pc, ax=ax, label="Loomulik iive")
     ax.set_title(f'Loomulik iive maakonniti aastal {year}')
     ax.axis('off')
-    plt.tight_layout()
+    fig.tight_layout()
     return fig
 
+def year_values(year_groups, year):
+    df = get_data_for_year(year_groups, year)
+    return tuple(df['Loomulik iive'].tolist()) if df is not None else ()
+
+# Keyed on the year's values as well as the year, so data refreshed by
+# import_data's TTL renders a new map rather than hitting a stale one.
+@st.cache_resource(max_entries=32, show_spinner=False)
+def render_year(year, values, _year_groups):
+    fig = create_plot(get_data_for_year(_year_groups, year), year)
+    if fig is None:
+        return None
+    buf = BytesIO()
+    fig.savefig(buf, format='png', dpi=200, bbox_inches='tight')
+    return buf.getvalue()
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def prerender_years(year_values_by_year, _year_groups):
+    # Only a handful of years to choose from, so render them all in the
+    # background once per data refresh and let later selections hit the cache.
+    executor = ThreadPoolExecutor(max_workers=2)
+    for year, values in year_values_by_year:
+        executor.submit(render_year, year, values, _year_groups)
+    executor.shutdown(wait=False)
+
 # --- Main ---
-df = import_data()
-gdf = import_geojson()
+if DEBUG:
+    st.sidebar.checkbox('Debug', value=True, key='debug')
+
+# The API call and the geometry load are independent; overlap them.
+with ThreadPoolExecutor(max_workers=1) as executor:
+    gdf_future = executor.submit(import_geojson)
+    df = load_data()
+    gdf = load_geojson(gdf_future)
 
 if df is not None and gdf is not None:
-    merged = gdf.merge(df, left_on='MNIMI', right_on='Maakond')
-    merged['Loomulik iive'] = merged['Mehed Loomulik iive'] + merged['Naised Loomulik iive']
+    year_groups = prepare_map_data(df, gdf)
 
     st.subheader("Data Overview")
-    st.write(f"Years: {merged['Aasta'].min()}–{merged['Aasta'].max()}")
+    years = list(year_groups)
+    st.write(f"Years: {years[0]}–{years[-1]}")
     st.write(f"{len(gdf)} counties loaded")
 
-    years = sorted(merged['Aasta'].unique())
     sel = st.selectbox("Select Year", years, index=len(years)-1)
 
-    year_df = get_data_for_year(merged, sel)
-    fig = create_plot(year_df, sel)
-    if fig:
-        st.pyplot(fig)
+    values = year_values(year_groups, sel)
+    png = render_year(sel, values, year_groups)
+    if png:
+        st.image(png)
     else:
         st.warning("No data for that year.")
 
     with st.expander("View Data Table"):
-        st.dataframe(year_df)
+        st.dataframe(year_table(sel, values, year_groups))
+
+    st.download_button("Download CSV", year_csv_bytes(sel, values, year_groups), file_name=f"growth_{sel}.csv")
 
-    csv = year_df.to_csv(index=False).encode('utf-8')
-    st.download_button("Download CSV", csv, file_name=f"growth_{sel}.csv")
+    # Warm the other years only once the visible page is built, so the
+    # background renders don't compete with the first paint.
+    prerender_years(tuple((y, year_values(year_groups, y)) for y in years), year_groups)
 
 else:
     st.warning("Make sure both the API data and GeoJSON file are available.")
+
+if DEBUG:
+    with st.sidebar.expander("Cache stats"):
+        lock, stats = cache_stats()
+        with lock:
+            snapshot = {name: {**s, 'hits': s['calls'] - s['misses']} for name, s in stats.items()}
+        st.json(snapshot)